@@ -0,0 +1,80 @@
+"""
+Compares the memory-mapped flat index with Qdrant local mode on random vectors.
+
+    python benchmark_vector_store.py --points 20000 --sources 50
+"""
+import argparse
+import shutil
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from flat_index import FlatIndexStorage
+from vector_db import QdrantStorage
+
+UPSERT_BATCH = 500
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def run(name, make_store, vectors, sources, queries, top_k):
+    points = len(vectors)
+    ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{sources[i]}:{i}")) for i in range(points)]
+    payloads = [{"source": sources[i], "text": f"chunk {i}"} for i in range(points)]
+
+    store = make_store()
+    _, upsert_s = _timed(lambda: [
+        store.upsert(ids[i:i + UPSERT_BATCH], vectors[i:i + UPSERT_BATCH].tolist(), payloads[i:i + UPSERT_BATCH])
+        for i in range(0, points, UPSERT_BATCH)
+    ])
+    del store
+
+    store, open_s = _timed(make_store)
+
+    _, search_s = _timed(lambda: [store.search(q.tolist(), top_k) for q in queries])
+    filter_sources = sorted(set(sources))[:2]
+    _, filtered_s = _timed(lambda: [store.search(q.tolist(), top_k, filter_sources=filter_sources) for q in queries])
+
+    n = len(queries)
+    print(
+        f"{name:<14} upsert {points / upsert_s:10.0f} pts/s   open {open_s * 1000:9.1f} ms   "
+        f"search {search_s / n * 1000:8.2f} ms/q   filtered {filtered_s / n * 1000:8.2f} ms/q"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--sources", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((args.points, args.dim), dtype=np.float32)
+    sources = [f"file_{i % args.sources}.pdf" for i in range(args.points)]
+    queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+
+    print(f"{args.points} points, dim {args.dim}, {args.sources} sources, {args.queries} queries, top_k {args.top_k}")
+    backends = [
+        ("qdrant-local", lambda path: QdrantStorage(path=path, dim=args.dim)),
+        ("flat-float32", lambda path: FlatIndexStorage(path=path, dim=args.dim, dtype="float32")),
+        ("flat-float16", lambda path: FlatIndexStorage(path=path, dim=args.dim, dtype="float16")),
+    ]
+    for name, factory in backends:
+        path = tempfile.mkdtemp(prefix="bench_")
+        try:
+            run(name, lambda: factory(path), vectors, sources, queries, args.top_k)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import datetime
+import json
+import os
+import time
+
+from custom_types import RAGChatSession, RAGSearchResult
+from gemini_client import create_cache, delete_cache, generate_content, is_retryable
+
+session_file = "chat_context.json"
+
+# Contexts a chat keeps in its prompt. Evidence added after the cache was built
+# (the uncached tail) is trimmed oldest-first so the cached prefix survives until
+# the cache expires; only then is the prefix rebuilt from the newest contexts.
+MAX_SESSION_CONTEXTS = 10
+# Room the tail always has, even when the cached prefix fills MAX_SESSION_CONTEXTS.
+MAX_UNCACHED_CONTEXTS = 5
+# Follow-ups only add evidence at least this similar to the question; the first
+# question of a chat takes the top_k results as before.
+FOLLOWUP_MIN_SCORE = 0.55
+
+# Gemini only caches prompts above a minimum token count (~1024 for Flash);
+# roughly 4 characters per token.
+CACHE_MIN_CHARS = 4096
+CACHE_TTL = datetime.timedelta(minutes=int(os.getenv("CHAT_CACHE_TTL_MIN", "10")))
+# Don't start a generation on a cache that is about to expire.
+CACHE_EXPIRY_MARGIN_S = 60
+
+
+def _load_sessions() -> dict:
+    if not os.path.exists(session_file):
+        return {}
+    try:
+        with open(session_file, "r") as f:
+            return json.load(f)
+    except:
+        return {}
+
+
+def load_session(chat_id: str | None) -> RAGChatSession:
+    if not chat_id:
+        return RAGChatSession()
+    data = _load_sessions().get(chat_id)
+    if data is None:
+        return RAGChatSession(chat_id=chat_id)
+    return RAGChatSession(**data)
+
+
+def save_session(session: RAGChatSession):
+    if not session.chat_id:
+        return
+    sessions = _load_sessions()
+    sessions[session.chat_id] = session.model_dump()
+    with open(session_file, "w") as f:
+        json.dump(sessions, f, indent=2)
+
+
+def _drop_cache(session: RAGChatSession):
+    if session.cache_name:
+        # Delete rather than wait for the TTL, which keeps billing storage.
+        try:
+            delete_cache(session.cache_name)
+        except Exception as e:
+            print(f"Context cache deletion failed: {e}")
+    session.cache_name = None
+    session.cache_model = None
+    session.cached_count = 0
+    session.cache_expires_at = 0.0
+
+
+def _keep(session: RAGChatSession, keep: list):
+    session.context_ids = [session.context_ids[i] for i in keep]
+    session.contexts = [session.contexts[i] for i in keep]
+    session.context_sources = [session.context_sources[i] for i in keep]
+
+
+def restrict_to_sources(session: RAGChatSession, file_names: list) -> RAGChatSession:
+    """Drops contexts from files that are no longer part of the chat."""
+    if not file_names:
+        return session
+    keep = [i for i, s in enumerate(session.context_sources) if s in file_names]
+    if len(keep) == len(session.contexts):
+        return session
+    if not keep:
+        # No overlap at all means the file list doesn't describe this chat (e.g. a
+        # stale list from another chat), not that every file was removed.
+        return session
+    _keep(session, keep)
+    _drop_cache(session)
+    return session
+
+
+def add_evidence(session: RAGChatSession, found: RAGSearchResult) -> RAGChatSession:
+    """
+    Appends retrieved contexts the chat doesn't have yet. Existing contexts keep
+    their order so the prompt prefix, and any cache built from it, stays valid.
+    """
+    known = set(session.context_ids)
+    for point_id, text, source in zip(found.ids, found.contexts, found.context_sources):
+        if point_id not in known:
+            session.context_ids.append(point_id)
+            session.contexts.append(text)
+            session.context_sources.append(source)
+
+    tail_room = max(MAX_SESSION_CONTEXTS - session.cached_count, MAX_UNCACHED_CONTEXTS)
+    overflow = len(session.contexts) - session.cached_count - tail_room
+    if overflow > 0:
+        tail = range(session.cached_count + overflow, len(session.contexts))
+        _keep(session, list(range(session.cached_count)) + list(tail))
+    return session
+
+
+def _context_block(contexts: list) -> str:
+    return "\n\n".join(f"- {c}" for c in contexts)
+
+
+def _ensure_cache(session: RAGChatSession, model_name: str, system_prompt: str):
+    """Returns a freshly created cache, or None when the session's cache (if any) is reused."""
+    alive = session.cache_name and session.cache_expires_at > time.time() + CACHE_EXPIRY_MARGIN_S
+    if alive:
+        return None
+    _drop_cache(session)
+    # The prefix is being rebuilt anyway, so this is the point to evict the oldest contexts.
+    overflow = len(session.contexts) - MAX_SESSION_CONTEXTS
+    if overflow > 0:
+        _keep(session, list(range(overflow, len(session.contexts))))
+    block = _context_block(session.contexts)
+    if len(system_prompt) + len(block) < CACHE_MIN_CHARS:
+        return None
+    try:
+        cache = create_cache(
+            model_name,
+            system_instruction=system_prompt,
+            contents=[f"Context from documents:\n{block}"],
+            ttl=CACHE_TTL,
+        )
+    except Exception as e:
+        # Caching is an optimisation; fall back to sending the full prompt.
+        print(f"Context cache creation failed: {e}")
+        return None
+    session.cache_name = cache.name
+    session.cache_model = cache.model
+    session.cached_count = len(session.contexts)
+    session.cache_expires_at = cache.expire_time.timestamp()
+    return cache
+
+
+def generate_with_context(session: RAGChatSession, question: str, model_name: str, system_prompt: str) -> str:
+    """
+    Answers `question` over the chat's accumulated contexts. The system prompt
+    and contexts already seen are served from a Gemini context cache when one is
+    available, so follow-ups only send the new evidence and the question. Without
+    a cache the prompt is laid out prefix-first so Gemini's implicit caching can
+    still reuse it.
+    """
+    cache = _ensure_cache(session, model_name, system_prompt)
+
+    if session.cache_name:
+        new_contexts = session.contexts[session.cached_count:]
+        prompt = ""
+        if new_contexts:
+            prompt += f"Additional context from documents:\n{_context_block(new_contexts)}\n\n"
+        prompt += f"User Question: {question}"
+        try:
+            cached_model = session.cache_model or model_name
+            return generate_content(cached_model, prompt, cached_content=cache or session.cache_name).text
+        except Exception as e:
+            if is_retryable(e):
+                raise
+            print(f"Cached generation failed, retrying without cache: {e}")
+            _drop_cache(session)
+
+    prompt = f"Context from documents:\n{_context_block(session.contexts)}\n\nUser Question: {question}"
+    return generate_content(model_name, prompt, system_instruction=system_prompt).text
@@ -4,10 +4,13 @@ from typing import List
 class RAGChunkAndSrc(pydantic.BaseModel):
     chunks: List[str]        
     source_id: str | None = None
+    tenant: str | None = None
 
 class RAGSearchResult(pydantic.BaseModel):
     contexts: List[str]
     sources: List[str]
+    ids: List[str] = []
+    context_sources: List[str] = []
 
 class RAGUpsertResult(pydantic.BaseModel):
     ingested: int
@@ -16,3 +19,18 @@ class RAGQueryResult(pydantic.BaseModel):
     answer: str
     sources: List[str]
     num_contexts: int
+
+class RAGChatSession(pydantic.BaseModel):
+    chat_id: str | None = None
+    context_ids: List[str] = []
+    contexts: List[str] = []
+    context_sources: List[str] = []
+    # Gemini context cache holding the system prompt plus contexts[:cached_count]
+    cache_name: str | None = None
+    cache_model: str | None = None
+    cached_count: int = 0
+    cache_expires_at: float = 0.0
+
+class RAGAnswer(pydantic.BaseModel):
+    text: str
+    session: RAGChatSession
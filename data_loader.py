@@ -4,6 +4,7 @@ import PIL.Image
 from llama_index.readers.file import PDFReader
 from llama_index.core.node_parser import SentenceSplitter
 from dotenv import load_dotenv
+from gemini_client import embed_batch, embed_content, generate_content
 
 load_dotenv()
 
@@ -30,7 +31,6 @@ def load_and_chunk_image(path: str):
     and then chunks that text valid for RAG.
     """
     img = PIL.Image.open(path)
-    model = genai.GenerativeModel('gemini-2.5-flash')
     
     prompt = """
     Analyze this image in extreme detail. 
@@ -39,30 +39,23 @@ def load_and_chunk_image(path: str):
     If it is a general image, describe everything visible.
     """
     
-    response = model.generate_content([prompt, img])
+    response = generate_content('gemini-2.5-flash', [prompt, img])
     text = response.text
     
     return Splitter.split_text(text)
 
 def embed_texts(texts: list[str]) -> list[list[float]]:
-    # CHANGED: Loop through texts and embed using Gemini
-    # Note: For production, you might want to batch these 10-100 at a time, 
-    # but a simple loop works fine for small files in the free tier.
-    embeddings = []
-    for text in texts:
-        result = genai.embed_content(
-            model=EMBED_MODEL,
-            content=text,
-            task_type="retrieval_document",
-            title="Embedded Document" 
-        )
-        embeddings.append(result['embedding'])
-    
-    return embeddings
+    # Batched through the shared rate limiter; batch size adapts to quota pressure.
+    return embed_batch(
+        EMBED_MODEL,
+        texts,
+        task_type="retrieval_document",
+        title="Embedded Document"
+    )
 
 # Helper for query embedding (single text)
 def embed_query(text: str) -> list[float]:
-    result = genai.embed_content(
+    result = embed_content(
         model=EMBED_MODEL,
         content=text,
         task_type="retrieval_query"
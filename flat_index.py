@@ -0,0 +1,349 @@
+import hashlib
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+@contextmanager
+def _exclusive_lock(path):
+    """Holds an exclusive lock on `path` across processes and threads."""
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after ~10s; keep waiting
+                    time.sleep(0.1)
+        else:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def safe_tenant(tenant: str) -> str:
+    """Makes a tenant key safe to use as a directory or collection name."""
+    cleaned = re.sub(r"[^A-Za-z0-9_-]", "_", tenant)[:64]
+    if cleaned != tenant:
+        # Keep distinct tenants distinct after cleaning.
+        cleaned = f"{cleaned}-{hashlib.sha1(tenant.encode()).hexdigest()[:10]}"
+    return cleaned
+
+
+class FlatIndexStorage:
+    """
+    Brute-force vector store with the same upsert/search interface as QdrantStorage.
+
+    Vectors are L2-normalised and kept in a memory-mapped matrix, so cosine
+    similarity is a plain dot product and only the pages a search touches are
+    read. Payloads are appended to a JSON lines file and only read back for the
+    top-k hits. A small append-only log maps each point id to its row, source
+    and payload offset; it is replayed on open to rebuild the id -> row map and
+    a per-source row index. Writers take a file lock and catch up on the log
+    before allocating rows, so several processes can ingest into the same
+    directory. Once re-ingests have left enough superseded entries behind, the
+    log and payload file are compacted into a new generation.
+    """
+
+    # Rows scanned per matrix multiply when searching without a source filter.
+    SEARCH_BATCH = 65536
+    # Compact once the log holds this many times more entries than live rows
+    # (plus COMPACT_MIN_ENTRIES, so small stores aren't rewritten constantly).
+    COMPACT_RATIO = 2
+    COMPACT_MIN_ENTRIES = 1000
+
+    def __init__(self, path="flat_storage", collection="docs_gemini", dim=768, dtype="float32", tenant=None):
+        self.dir = os.path.join(self.partition_path(path, tenant), collection)
+        os.makedirs(self.dir, exist_ok=True)
+        self.vectors_path = os.path.join(self.dir, "vectors.bin")
+        self.lock_path = os.path.join(self.dir, "lock")
+        self.meta_path = os.path.join(self.dir, "meta.json")
+
+        with _exclusive_lock(self.lock_path):
+            if os.path.exists(self.meta_path):
+                meta = self._read_meta()
+                dim, dtype = meta["dim"], meta["dtype"]
+            else:
+                self._write_meta({"dim": dim, "dtype": dtype, "generation": 0})
+
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = self.dim * self.dtype.itemsize
+        self._load_state()
+
+    @staticmethod
+    def partition_path(path="flat_storage", tenant=None):
+        # Each tenant gets its own directory, so opening and searching only touch its documents.
+        return os.path.join(path, "tenants", safe_tenant(tenant)) if tenant else path
+
+    @classmethod
+    def partition_exists(cls, tenant, path="flat_storage", collection="docs_gemini"):
+        return os.path.isdir(os.path.join(cls.partition_path(path, tenant), collection))
+
+    def _read_meta(self):
+        with open(self.meta_path, "r") as f:
+            return json.load(f)
+
+    def _write_meta(self, meta):
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def _log_path(self, generation):
+        return os.path.join(self.dir, f"log.{generation}.jsonl")
+
+    def _payloads_path(self, generation):
+        return os.path.join(self.dir, f"payloads.{generation}.jsonl")
+
+    def _load_state(self):
+        self.generation = self._read_meta().get("generation", 0)
+        self.ids = {}           # point id -> row
+        self.row_ids = []       # row -> point id
+        self.row_sources = []   # row -> source
+        self.payload_refs = []  # row -> (offset, length) in the payload file
+        self.source_rows = {}   # source -> set of rows
+        self._log_offset = 0    # bytes of the log already replayed
+        self._log_entries = 0
+        self._replay_log()
+        self._matrix = None
+
+    def _replay_log(self, locked=False):
+        """Applies log entries written since the last replay."""
+        log_path = self._log_path(self.generation)
+        if not os.path.exists(log_path):
+            return
+        with open(log_path, "rb+") as f:
+            f.seek(self._log_offset)
+            data = f.read()
+            complete = data.rfind(b"\n") + 1
+            if complete < len(data) and locked:
+                # A torn last line. A reader can't tell it from a writer mid-append,
+                # but a lock holder knows the writer died and may drop it.
+                f.truncate(self._log_offset + complete)
+        if not complete:
+            return
+        # One parse for the whole tail is much faster than json.loads per line.
+        entries = json.loads(b"[" + data[:complete - 1].replace(b"\n", b",") + b"]")
+        for entry in entries:
+            self._index(entry["id"], entry["row"], entry["source"], (entry["off"], entry["len"]))
+        self._log_offset += complete
+        self._log_entries += len(entries)
+
+    def _index(self, point_id, row, source, ref):
+        if row == len(self.row_ids):
+            self.row_ids.append(point_id)
+            self.row_sources.append(source)
+            self.payload_refs.append(ref)
+        else:
+            old_source = self.row_sources[row]
+            if old_source in self.source_rows:
+                self.source_rows[old_source].discard(row)
+            self.row_sources[row] = source
+            self.payload_refs[row] = ref
+        self.ids[point_id] = row
+        if source:
+            self.source_rows.setdefault(source, set()).add(row)
+
+    @property
+    def count(self):
+        return len(self.row_ids)
+
+    def _open_matrix(self):
+        if self._matrix is None and self.count:
+            self._matrix = np.memmap(
+                self.vectors_path, dtype=self.dtype, mode="r", shape=(self.count, self.dim)
+            )
+        return self._matrix
+
+    def upsert(self, ids, vectors, payloads):
+        vecs = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        vecs = (vecs / np.where(norms == 0, 1, norms)).astype(self.dtype)
+
+        # Repeated ids within a batch keep the last occurrence, as Qdrant does.
+        latest = {str(point_id): i for i, point_id in enumerate(ids)}
+        ids = list(latest)
+        vecs = vecs[list(latest.values())]
+        payloads = [payloads[i] for i in latest.values()]
+
+        with _exclusive_lock(self.lock_path):
+            # Pick up rows other writers added since this store was opened.
+            if self._read_meta().get("generation", 0) != self.generation:
+                self._load_state()
+            self._replay_log(locked=True)
+
+            rows = []
+            next_row = self.count
+            for point_id in ids:
+                if point_id in self.ids:
+                    rows.append(self.ids[point_id])
+                else:
+                    rows.append(next_row)
+                    next_row += 1
+
+            # Vectors and payloads are written before the log so a log entry never
+            # points at missing data.
+            mode = "r+b" if os.path.exists(self.vectors_path) else "w+b"
+            with open(self.vectors_path, mode) as f:
+                f.truncate(next_row * self.row_bytes)
+                for row, vec in zip(rows, vecs):
+                    f.seek(row * self.row_bytes)
+                    f.write(vec.tobytes())
+
+            refs = []
+            with open(self._payloads_path(self.generation), "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                for payload in payloads:
+                    data = json.dumps(payload).encode() + b"\n"
+                    f.write(data)
+                    refs.append((offset, len(data)))
+                    offset += len(data)
+
+            with open(self._log_path(self.generation), "ab") as f:
+                for point_id, row, payload, (off, length) in zip(ids, rows, payloads, refs):
+                    entry = {"id": point_id, "row": row, "source": payload.get("source"), "off": off, "len": length}
+                    f.write((json.dumps(entry) + "\n").encode())
+
+            self._replay_log(locked=True)
+            if self._log_entries > self.COMPACT_RATIO * self.count + self.COMPACT_MIN_ENTRIES:
+                self._compact()
+        self._matrix = None
+
+    def compact(self):
+        """Rewrites the log and payload file with only the live entry for each row."""
+        with _exclusive_lock(self.lock_path):
+            if self._read_meta().get("generation", 0) != self.generation:
+                self._load_state()
+            self._replay_log(locked=True)
+            self._compact()
+
+    def _compact(self):
+        # Called with the lock held and the log fully replayed.
+        old, new = self.generation, self.generation + 1
+        with open(self._payloads_path(old), "rb") as src, \
+                open(self._payloads_path(new), "wb") as payloads_out, \
+                open(self._log_path(new), "wb") as log_out:
+            offset = 0
+            for row, (point_id, source, (off, length)) in enumerate(
+                zip(self.row_ids, self.row_sources, self.payload_refs)
+            ):
+                src.seek(off)
+                payloads_out.write(src.read(length))
+                entry = {"id": point_id, "row": row, "source": source, "off": offset, "len": length}
+                log_out.write((json.dumps(entry) + "\n").encode())
+                offset += length
+
+        meta = self._read_meta()
+        meta["generation"] = new
+        self._write_meta(meta)
+
+        # Stores opened on the previous generation may still read its payloads,
+        # so only the one before that is removed.
+        for stale in (self._log_path(old - 1), self._payloads_path(old - 1)):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+        self._load_state()
+
+    def _read_payloads(self, rows):
+        payloads = []
+        if not len(rows):
+            # An empty store has no payload file yet.
+            return payloads
+        with open(self._payloads_path(self.generation), "rb") as f:
+            for row in rows:
+                off, length = self.payload_refs[row]
+                f.seek(off)
+                payloads.append(json.loads(f.read(length)))
+        return payloads
+
+    def _top_k(self, scores, rows, k):
+        if len(scores) > k:
+            idx = np.argpartition(-scores, k - 1)[:k]
+            return scores[idx], rows[idx]
+        return scores, rows
+
+    def search(self, query_vector, top_k=5, filter_sources=None, score_threshold=None):
+        matrix = self._open_matrix()
+        best_scores = np.empty(0, dtype=np.float32)
+        best_rows = np.empty(0, dtype=np.int64)
+
+        if matrix is not None:
+            q = np.asarray(query_vector, dtype=np.float32)
+            q = q / (np.linalg.norm(q) or 1)
+
+            if filter_sources:  # Only filter if files were actually provided
+                candidate_rows = sorted(
+                    {r for s in filter_sources for r in self.source_rows.get(s, [])}
+                )
+                batches = [np.asarray(candidate_rows, dtype=np.int64)]
+            else:
+                batches = [
+                    np.arange(start, min(start + self.SEARCH_BATCH, self.count))
+                    for start in range(0, self.count, self.SEARCH_BATCH)
+                ]
+
+            for rows in batches:
+                if not len(rows):
+                    continue
+                block = matrix[rows] if filter_sources else matrix[rows[0]:rows[-1] + 1]
+                scores = block.astype(np.float32) @ q
+                scores, rows = self._top_k(scores, rows, top_k)
+                best_scores, best_rows = self._top_k(
+                    np.concatenate([best_scores, scores]),
+                    np.concatenate([best_rows, rows]),
+                    top_k,
+                )
+
+        order = np.argsort(-best_scores)
+        if score_threshold is not None:
+            order = order[best_scores[order] >= score_threshold]
+        ids = []
+        contexts = []
+        context_sources = []
+        sources = set()
+
+        top_rows = best_rows[order]
+        try:
+            top_payloads = self._read_payloads(top_rows)
+        except FileNotFoundError:
+            # Compacted twice since this store was opened; reload and search again.
+            self._load_state()
+            return self.search(query_vector, top_k, filter_sources, score_threshold)
+
+        for row, payload in zip(top_rows, top_payloads):
+            payload = payload or {}
+            text = payload.get("text", "")
+            source = payload.get("source", "")
+
+            if text:
+                ids.append(self.row_ids[row])
+                contexts.append(text)
+                context_sources.append(source)
+                if source:
+                    sources.add(source)
+
+        return {
+            "ids": ids,
+            "contexts": contexts,
+            "context_sources": context_sources,
+            "sources": list(sources),
+        }
@@ -0,0 +1,275 @@
+import os
+import random
+import sqlite3
+import time
+from contextlib import closing
+
+import google.generativeai as genai
+from google.generativeai import caching
+from google.generativeai.client import get_default_cache_client
+from dotenv import load_dotenv
+
+load_dotenv()
+
+genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+
+# Shared limiter state lives in SQLite so every worker (FastAPI, Inngest steps,
+# helper scripts) draws from the same bucket.
+RATE_LIMIT_DB = os.getenv("GEMINI_RATE_LIMIT_DB", "gemini_rate_limit.db")
+
+# Requests per minute for each bucket. Under quota pressure the effective rate
+# drops towards MIN_RATE_FRACTION of this and recovers as calls succeed again.
+BUCKET_RPM = {
+    "embed": float(os.getenv("GEMINI_EMBED_RPM", "1500")),
+    "generate": float(os.getenv("GEMINI_GENERATE_RPM", "10")),
+    # Context cache metadata calls (create/get/delete) have their own quota.
+    "cache": float(os.getenv("GEMINI_CACHE_RPM", "60")),
+}
+MIN_RATE_FRACTION = 0.1
+RATE_DECREASE = 0.5    # multiplicative decrease on 429
+RATE_INCREASE = 0.05   # additive increase (fraction of max) on success
+
+MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "6"))
+BACKOFF_BASE_S = 1.0
+BACKOFF_MAX_S = 60.0
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# Gemini accepts at most 100 texts per batch embed request.
+EMBED_MAX_BATCH = 100
+EMBED_MIN_BATCH = 1
+# Clean batches in a row before trying a batch size that previously hit the quota.
+EMBED_PROBE_AFTER = 10
+
+
+def _capacity(rate):
+    # One second's worth of requests, but never below a single call.
+    return max(1.0, rate)
+
+
+class RateLimiter:
+    """Token bucket persisted in SQLite and shared across processes."""
+
+    def __init__(self, path=RATE_LIMIT_DB):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS buckets (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    rate REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _max_rate(self, name):
+        # Stored rates are tokens per second, configured values are per minute.
+        return BUCKET_RPM[name] / 60.0
+
+    def _load(self, conn, name, now):
+        row = conn.execute(
+            "SELECT tokens, rate, updated_at FROM buckets WHERE name = ?", (name,)
+        ).fetchone()
+        max_rate = self._max_rate(name)
+        if row is None:
+            return 1.0, max_rate
+        tokens, rate, updated_at = row
+        tokens = min(_capacity(rate), tokens + (now - updated_at) * rate)
+        return tokens, min(rate, max_rate)
+
+    def _store(self, conn, name, tokens, rate, now):
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (name, tokens, rate, updated_at) VALUES (?, ?, ?, ?)",
+            (name, tokens, rate, now),
+        )
+
+    def acquire(self, name, cost=1.0):
+        """Block until `cost` tokens are available in bucket `name`."""
+        while True:
+            with closing(self._connect()) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    now = time.time()
+                    tokens, rate = self._load(conn, name, now)
+                    # Costs above the bucket capacity are let through once it is full
+                    # and paid back as debt, so large batches cannot starve.
+                    needed = min(cost, _capacity(rate))
+                    if tokens >= needed:
+                        self._store(conn, name, tokens - cost, rate, now)
+                        conn.execute("COMMIT")
+                        return
+                    self._store(conn, name, tokens, rate, now)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            time.sleep((needed - tokens) / rate)
+
+    def _adjust(self, name, fn):
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                tokens, rate = self._load(conn, name, now)
+                max_rate = self._max_rate(name)
+                rate = min(max_rate, max(max_rate * MIN_RATE_FRACTION, fn(rate, max_rate)))
+                self._store(conn, name, tokens, rate, now)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def throttle(self, name):
+        """Back off the shared rate after the API reported quota pressure."""
+        self._adjust(name, lambda rate, max_rate: rate * RATE_DECREASE)
+
+    def recover(self, name):
+        """Creep the shared rate back up after a successful call."""
+        self._adjust(name, lambda rate, max_rate: rate + max_rate * RATE_INCREASE)
+
+
+_limiter = None
+
+
+def get_limiter() -> RateLimiter:
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter()
+    return _limiter
+
+
+def _status_code(exc):
+    # google.api_core exceptions carry the HTTP status as an int `code`.
+    code = getattr(exc, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(exc) -> bool:
+    return _status_code(exc) in RETRYABLE_STATUS
+
+
+def is_quota_error(exc) -> bool:
+    return _status_code(exc) == 429
+
+
+def _backoff(attempt):
+    # Full jitter keeps workers that hit a 429 together from retrying in lockstep.
+    return random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt))
+
+
+def call_with_retry(bucket: str, fn, *args, cost: float = 1.0, retry_quota: bool = True, **kwargs):
+    """
+    Call a Gemini API function through the shared limiter, retrying 429/5xx.
+    With retry_quota=False a 429 is raised straight away so the caller can
+    shrink its request instead.
+    """
+    limiter = get_limiter()
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire(bucket, cost)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if is_quota_error(e):
+                limiter.throttle(bucket)
+                if not retry_quota:
+                    raise
+            if not is_retryable(e) or attempt == MAX_RETRIES:
+                raise
+            delay = _backoff(attempt)
+            print(f"Gemini {bucket} call failed ({e}); retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        limiter.recover(bucket)
+        return result
+
+
+def _model_path(model_name: str) -> str:
+    return model_name if model_name.startswith("models/") else f"models/{model_name}"
+
+
+def generate_content(model_name: str, contents, system_instruction=None,
+                     cached_content: "str | caching.CachedContent | None" = None, **kwargs):
+    if cached_content:
+        # The cache already carries the system instruction and its contents. Given
+        # a name, build the handle locally (model_name must be the model the cache
+        # was created for) instead of paying a CachedContent.get round trip.
+        if isinstance(cached_content, str):
+            cached_content = caching.CachedContent._from_obj({"name": cached_content, "model": _model_path(model_name)})
+        model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+    else:
+        model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+    return call_with_retry("generate", model.generate_content, contents, **kwargs)
+
+
+def create_cache(model_name: str, system_instruction, contents, ttl) -> caching.CachedContent:
+    return call_with_retry(
+        "cache", caching.CachedContent.create,
+        model=_model_path(model_name), system_instruction=system_instruction, contents=contents, ttl=ttl
+    )
+
+
+def delete_cache(name: str):
+    # Deleting by name directly avoids the lookup CachedContent(name) would make first.
+    client = get_default_cache_client()
+    call_with_retry("cache", client.delete_cached_content, genai.protos.DeleteCachedContentRequest(name=name))
+
+
+def embed_content(model: str, content, **kwargs):
+    return call_with_retry("embed", genai.embed_content, model=model, content=content, **kwargs)
+
+
+def embed_batch(model: str, texts: list[str], **kwargs) -> list[list[float]]:
+    """
+    Embeds texts in batches, halving the batch size whenever the quota is hit.
+    The size then grows back one text per successful batch up to the largest
+    size that went through; larger sizes are only probed after a run of clean
+    batches, and each failed probe doubles the run needed for the next one.
+    """
+    embeddings = []
+    batch_size = EMBED_MAX_BATCH
+    limit = EMBED_MAX_BATCH  # largest batch size not known to hit the quota
+    last_ok = 0              # largest batch size that went through
+    probe_after = EMBED_PROBE_AFTER
+    clean = 0
+    shrinks = 0
+    i = 0
+    while i < len(texts):
+        batch = texts[i:i + batch_size]
+        try:
+            # A batch request counts against the quota once per text.
+            result = call_with_retry(
+                "embed", genai.embed_content, model=model, content=batch,
+                cost=len(batch), retry_quota=len(batch) <= EMBED_MIN_BATCH, **kwargs
+            )
+        except Exception as e:
+            if not is_quota_error(e) or len(batch) <= EMBED_MIN_BATCH:
+                raise
+            limit = max(EMBED_MIN_BATCH, len(batch) - 1)
+            if last_ok and len(batch) > last_ok:
+                # A failed probe: drop back to the size known to work.
+                batch_size = min(last_ok, limit)
+                probe_after *= 2
+            else:
+                batch_size = max(EMBED_MIN_BATCH, len(batch) // 2)
+                last_ok = 0
+            clean = 0
+            # Not reset on success, so repeated quota hits keep backing off further.
+            delay = _backoff(shrinks)
+            shrinks += 1
+            print(f"Embedding quota exhausted, shrinking batch size to {batch_size}; retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        embeddings.extend(result["embedding"])
+        i += len(batch)
+        last_ok = max(last_ok, len(batch))
+        clean += 1
+        if batch_size >= limit and clean >= probe_after:
+            limit = min(EMBED_MAX_BATCH, limit + 1)
+            clean = 0
+        batch_size = min(limit, batch_size + 1)
+    return embeddings
@@ -10,8 +10,10 @@ import google.generativeai as genai
 
 # Import the specific embed function for queries
 from data_loader import load_and_chunk_pdf, load_and_chunk_image, embed_texts, embed_query 
-from vector_db import QdrantStorage
-from custom_types import RAGChunkAndSrc, RAGUpsertResult, RAGSearchResult
+from gemini_client import is_retryable
+from vector_db import get_storage
+from chat_context import load_session, save_session, restrict_to_sources, add_evidence, generate_with_context, FOLLOWUP_MIN_SCORE
+from custom_types import RAGChunkAndSrc, RAGUpsertResult, RAGSearchResult, RAGChatSession, RAGAnswer
 
 load_dotenv()
 
@@ -34,13 +36,14 @@ inngest_client = inngest.Inngest(
     rate_limit=inngest.RateLimit(
         limit=1,
         period=datetime.timedelta(hours=4),
-        key="event.data.source_id",
+        key='(has(event.data.chat_id) && event.data.chat_id != null ? event.data.chat_id : "") + "-" + event.data.source_id',
   ),
 )
 async def rag_ingest_file(ctx: inngest.Context):
     def _load(ctx: inngest.Context) -> RAGChunkAndSrc:
         file_path = ctx.event.data["file_path"]
         source_id = ctx.event.data.get("source_id", file_path)
+        tenant = ctx.event.data.get("chat_id")
         
         # Check file extension
         ext = os.path.splitext(file_path)[1].lower()
@@ -51,15 +54,18 @@ async def rag_ingest_file(ctx: inngest.Context):
         else:
              chunks = [] # Or handle error
              
-        return RAGChunkAndSrc(chunks=chunks, source_id=source_id)
+        return RAGChunkAndSrc(chunks=chunks, source_id=source_id, tenant=tenant)
 
     def _upsert(chunks_and_src: RAGChunkAndSrc) -> RAGUpsertResult:
         chunks = chunks_and_src.chunks
         source_id = chunks_and_src.source_id
+        tenant = chunks_and_src.tenant
         vecs = embed_texts(chunks)
-        ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source_id}:{i}")) for i in range(len(chunks))]
-        payloads = [{"source": source_id, "text": chunks[i]} for i in range(len(chunks))]
-        QdrantStorage().upsert(ids, vecs, payloads)
+        # Tenant is part of the id so files with the same name in different chats don't overwrite each other
+        prefix = f"{tenant}:{source_id}" if tenant else source_id
+        ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{prefix}:{i}")) for i in range(len(chunks))]
+        payloads = [{"source": source_id, "tenant": tenant, "text": chunks[i]} for i in range(len(chunks))]
+        get_storage(tenant).upsert(ids, vecs, payloads)
         return RAGUpsertResult(ingested=len(chunks))
 
     chunks_and_src = await ctx.step.run("load-and-chunk", lambda: _load(ctx), output_type=RAGChunkAndSrc)
@@ -67,73 +73,90 @@ async def rag_ingest_file(ctx: inngest.Context):
     return ingested.model_dump()
 
 
+SYSTEM_PROMPT = """
+You are a PRECISE financial analyzer and advisor. Your goal is to help the user understand their bank statements and invoices with absolute clarity.
+
+### INSTRUCTIONS:
+1.  **Use Markdown Tables**: Whenever you list transactions, spending categories, or summary data, ALWAYS use Markdown tables.
+2.  **Professional Structure**: Use clear headings (##) and bold text for emphasis.
+3.  **Visual Clarity**: If there are multiple items, group them logically. 
+4.  **Financial Advice**: Provide a separate section titled "## 💡 Financial Advice & Insights" with actionable steps.
+5.  **Data for Charts**: If you identify spending categories and their total amounts (e.g. Food: $200, Rent: $1000), please also provide a JSON block at the VERY END of your response (after all text) in the following format:
+    ```json
+    {
+      "chart_data": [
+        {"category": "Category1", "amount": 100.50},
+        {"category": "Category2", "amount": 250.00}
+      ]
+    }
+    ```
+6.  **Be Concise**: Avoid fluff. Focus on data and insight.
+
+Respond in a clear, professional format as if you are a high-end financial dashboard.
+"""
+
 @inngest_client.create_function(
     fn_id="RAG: Query PDF",
     trigger=inngest.TriggerEvent(event="rag/query_pdf_ai")
 )
 async def rag_query_pdf_ai(ctx: inngest.Context):
     
-    # 1. Search Logic
-    def _search(question: str, top_k: int = 5, file_names: list = None) -> RAGSearchResult:
+    # 1. Search Logic - follow-ups pass a score threshold so only relevant new evidence is added
+    def _search(question: str, top_k: int = 5, file_names: list = None, score_threshold: float = None, tenant: str = None, legacy: bool = False) -> RAGSearchResult:
         # CHANGED: Use the specific query embedding function from data_loader
         query_vec = embed_query(question) 
-        store = QdrantStorage()
-        found = store.search(query_vec, top_k, filter_sources=file_names)
-        return RAGSearchResult(contexts=found["contexts"], sources=found["sources"])
+        # Only chats from before per-chat partitioning may read the old shared store;
+        # a new chat searches just its own partition, which is empty until its ingest lands
+        store = get_storage(tenant, fallback=legacy)
+        found = store.search(query_vec, top_k, filter_sources=file_names, score_threshold=score_threshold)
+        return RAGSearchResult(**found)
     
     # 2. Generation Logic (Gemini 2.5 Flash)
-    def _generate_answer(contexts: list, question: str) -> str:
+    def _generate_answer(session: RAGChatSession, question: str) -> RAGAnswer:
         try:
             print(f"Generating answer for: {question}")
-            model = genai.GenerativeModel('gemini-2.5-flash')
-            
-            context_block = "\n\n".join(f"- {c}" for c in contexts)
-            
-            prompt = f"""
-            You are a PRECISE financial analyzer and advisor. Your goal is to help the user understand their bank statements and invoices with absolute clarity.
-            
-            ### INSTRUCTIONS:
-            1.  **Use Markdown Tables**: Whenever you list transactions, spending categories, or summary data, ALWAYS use Markdown tables.
-            2.  **Professional Structure**: Use clear headings (##) and bold text for emphasis.
-            3.  **Visual Clarity**: If there are multiple items, group them logically. 
-            4.  **Financial Advice**: Provide a separate section titled "## 💡 Financial Advice & Insights" with actionable steps.
-            5.  **Data for Charts**: If you identify spending categories and their total amounts (e.g. Food: $200, Rent: $1000), please also provide a JSON block at the VERY END of your response (after all text) in the following format:
-                ```json
-                {{
-                  "chart_data": [
-                    {{"category": "Category1", "amount": 100.50}},
-                    {{"category": "Category2", "amount": 250.00}}
-                  ]
-                }}
-                ```
-            6.  **Be Concise**: Avoid fluff. Focus on data and insight.
-
-            Context from documents:
-            {context_block}
-
-            User Question: {question}
-            
-            Respond in a clear, professional format as if you are a high-end financial dashboard.
-            """
-            
-            response = model.generate_content(prompt)
+            text = generate_with_context(session, question, 'gemini-2.5-flash', SYSTEM_PROMPT)
             print("Generation successful")
-            return response.text
+            return RAGAnswer(text=text, session=session)
         except Exception as e:
             print(f"Error during generation: {e}")
+            if is_retryable(e):
+                # Quota/server errors outlived the client's own retries; let Inngest retry the step.
+                raise
             if hasattr(e, 'response') and hasattr(e.response, 'prompt_feedback'):
                 print(f"Safety Feedback: {e.response.prompt_feedback}")
-            return f"I apologize, but I encountered an error analyzing the document: {str(e)}"
+            return RAGAnswer(
+                text=f"I apologize, but I encountered an error analyzing the document: {str(e)}",
+                session=session
+            )
 
     question = ctx.event.data["question"]
     top_k = int(ctx.event.data.get("top_k", 5))
     file_names = ctx.event.data.get("file_names", [])
-
-    # Step 1: Retrieve
-    found = await ctx.step.run("embed-and-search", lambda: _search(question, top_k, file_names), output_type=RAGSearchResult)
-
-    # Step 2: Generate
-    full_response = await ctx.step.run("generate-answer", lambda: _generate_answer(found.contexts, question))
+    chat_id = ctx.event.data.get("chat_id")
+    legacy = bool(ctx.event.data.get("legacy", False))
+
+    # Step 1: Load what this chat has already retrieved
+    session = await ctx.step.run(
+        "load-session",
+        lambda: restrict_to_sources(load_session(chat_id), file_names),
+        output_type=RAGChatSession
+    )
+
+    # Step 2: Retrieve; add_evidence keeps only what the chat doesn't already have
+    found = await ctx.step.run(
+        "embed-and-search",
+        lambda: _search(question, top_k, file_names, FOLLOWUP_MIN_SCORE if session.contexts else None, chat_id, legacy),
+        output_type=RAGSearchResult
+    )
+    session = add_evidence(session, found)
+
+    # Step 3: Generate
+    result = await ctx.step.run("generate-answer", lambda: _generate_answer(session, question), output_type=RAGAnswer)
+    session = result.session
+    full_response = result.text
+
+    await ctx.step.run("save-session", lambda: save_session(session))
 
     # Parse out JSON if present for charts
     import json
@@ -151,8 +174,8 @@ async def rag_query_pdf_ai(ctx: inngest.Context):
 
     return {
         "answer": answer, 
-        "sources": found.sources, 
-        "num_contexts": len(found.contexts),
+        "sources": sorted(set(s for s in session.context_sources if s)), 
+        "num_contexts": len(session.contexts),
         "chart_data": chart_data
     }
 
@@ -14,7 +14,7 @@ def load_chats() -> List[Dict]:
     except:
         return []
 
-def save_chat(chat_id: str, title: str, messages: List[Dict]):
+def save_chat(chat_id: str, title: str, messages: List[Dict], files: Optional[List[str]] = None):
     chats = load_chats()
     # Check if chat exists
     existing = next((c for c in chats if c["id"] == chat_id), None)
@@ -25,10 +25,14 @@ def save_chat(chat_id: str, title: str, messages: List[Dict]):
         "messages": messages,
         "updated_at": datetime.now().isoformat()
     }
+    if files is not None:
+        updated_chat["files"] = files
 
     if existing:
         existing.update(updated_chat)
     else:
+        # Chats created from now on keep their documents in their own partition
+        updated_chat["partitioned"] = True
         chats.append(updated_chat)
     
     with open(chat_file, "w") as f:
@@ -38,6 +42,11 @@ def get_chat(chat_id: str) -> Optional[Dict]:
     chats = load_chats()
     return next((c for c in chats if c["id"] == chat_id), None)
 
+def is_legacy_chat(chat_id: str) -> bool:
+    # Saved before per-chat partitioning, so its documents are in the shared store
+    chat = get_chat(chat_id)
+    return chat is not None and not chat.get("partitioned", False)
+
 def delete_chat(chat_id: str):
     chats = load_chats()
     chats = [c for c in chats if c["id"] != chat_id]
@@ -7,7 +7,7 @@ import requests
 import os
 from pathlib import Path
 from dotenv import load_dotenv
-from storage import save_chat, get_chat, load_chats, rename_chat
+from storage import save_chat, get_chat, load_chats, rename_chat, is_legacy_chat
 import pandas as pd
 import plotly.express as px
 
@@ -144,14 +144,15 @@ def wait_for_run_output(event_id: str, timeout_s: float = 120.0, poll_interval_s
             raise TimeoutError(f"Timed out waiting for run output (last status: {last_status})")
         time.sleep(poll_interval_s)
 
-def save_uploaded_file(file) -> Path:
-    uploads_dir = Path("uploads")
+def save_uploaded_file(file, chat_id: str) -> Path:
+    # One folder per chat so same-named files from different chats don't overwrite each other
+    uploads_dir = Path("uploads") / chat_id
     uploads_dir.mkdir(parents=True, exist_ok=True)
     file_path = uploads_dir / file.name
     file_path.write_bytes(file.getbuffer())
     return file_path
 
-async def send_rag_ingest_event(file_path: Path) -> None:
+async def send_rag_ingest_event(file_path: Path, chat_id: str) -> None:
     client = get_inngest_client()
     await client.send(
         inngest.Event(
@@ -159,11 +160,12 @@ async def send_rag_ingest_event(file_path: Path) -> None:
             data={
                 "file_path": str(file_path.resolve()),
                 "source_id": file_path.name,
+                "chat_id": chat_id,
             },
         )
     )
 
-async def send_rag_query_event(question: str, top_k: int, file_names: list = None) -> str:
+async def send_rag_query_event(question: str, top_k: int, file_names: list = None, chat_id: str = None) -> str:
     client = get_inngest_client()
     result = await client.send(
         inngest.Event(
@@ -172,6 +174,8 @@ async def send_rag_query_event(question: str, top_k: int, file_names: list = Non
                 "question": question,
                 "top_k": top_k,
                 "file_names": file_names or [],
+                "chat_id": chat_id,
+                "legacy": bool(chat_id) and is_legacy_chat(chat_id),
             },
         )
     )
@@ -179,7 +183,8 @@ async def send_rag_query_event(question: str, top_k: int, file_names: list = Non
 
 # --- Session State Management ---
 if "current_chat_id" not in st.session_state:
-    st.session_state.current_chat_id = None
+    # Set up front: uploads in the sidebar need it as their tenant key
+    st.session_state.current_chat_id = str(uuid.uuid4())
 if "messages" not in st.session_state:
     st.session_state.messages = []
 if "processed_files" not in st.session_state:
@@ -218,6 +223,7 @@ with st.sidebar:
             if st.button(display_title, key=f"btn_{chat['id']}", use_container_width=True):
                 st.session_state.current_chat_id = chat["id"]
                 st.session_state.messages = chat["messages"]
+                st.session_state.processed_files = chat.get("files", []) # Restore this chat's files
                 st.rerun()
         
         with col2:
@@ -244,8 +250,8 @@ with st.sidebar:
             if st.button("⚡ Process Files", use_container_width=True):
                 with st.spinner("Processing..."):
                     for uploaded in uploaded_files:
-                        path = save_uploaded_file(uploaded)
-                        asyncio.run(send_rag_ingest_event(path))
+                        path = save_uploaded_file(uploaded, st.session_state.current_chat_id)
+                        asyncio.run(send_rag_ingest_event(path, st.session_state.current_chat_id))
                         if uploaded.name not in st.session_state.processed_files:
                             st.session_state.processed_files.append(uploaded.name)
                     st.success("Ready!")
@@ -253,10 +259,6 @@ with st.sidebar:
 
 # --- Main Interface ---
 
-# Initialize chat if needed
-if not st.session_state.current_chat_id:
-    st.session_state.current_chat_id = str(uuid.uuid4())
-
 # Display Title
 st.markdown("<h1 style='text-align: center; margin-top: -50px;'>Bank Statement & Invoice Analyzer</h1>", unsafe_allow_html=True)
 st.markdown("<p style='text-align: center; color: #888; margin-bottom: 40px;'>Ask questions about your finances. I will analyze your uploaded documents and give advice.</p>", unsafe_allow_html=True)
@@ -295,7 +297,7 @@ if prompt := st.chat_input("Ask about your statement or invoice..."):
         with st.spinner("📊 Analyzing data..."):
             try:
                 # Pass currently processed files for filtering
-                event_id = asyncio.run(send_rag_query_event(prompt, top_k=5, file_names=st.session_state.processed_files))
+                event_id = asyncio.run(send_rag_query_event(prompt, top_k=5, file_names=st.session_state.processed_files, chat_id=st.session_state.current_chat_id))
                 output = wait_for_run_output(event_id)
                 answer = output.get("answer", "I couldn't generate an answer.")
                 sources = output.get("sources", [])
@@ -330,7 +332,7 @@ if prompt := st.chat_input("Ask about your statement or invoice..."):
                 
                 # Save Chat
                 title = st.session_state.messages[0]["content"][:30] + "..." if st.session_state.messages else "New Chat"
-                save_chat(st.session_state.current_chat_id, title, st.session_state.messages)
+                save_chat(st.session_state.current_chat_id, title, st.session_state.messages, st.session_state.processed_files)
 
             except Exception as e:
                 st.error(f"An error occurred: {e}")
\ No newline at end of file
@@ -1,18 +1,58 @@
+import os
 from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
+from qdrant_client.models import VectorParams, Distance, PointStruct, KeywordIndexParams, KeywordIndexType
+from flat_index import safe_tenant
 
 class QdrantStorage:
     
-    def __init__(self, path="qdrant_storage", collection="docs_gemini", dim=768):
-        self.client = QdrantClient(path=path)
+    def __init__(self, path="qdrant_storage", collection="docs_gemini", dim=768, tenant=None, url=None):
+        url = url or os.getenv("QDRANT_URL")
+        self.tenant = tenant
         self.collection = collection
 
+        # Embedded Qdrant ignores payload indexes, scans every point and loads every
+        # collection under its path on open, so each tenant gets its own storage path
+        # there. A Qdrant server keeps one collection and groups each tenant's points
+        # together through an is_tenant payload index instead.
+        self.shared = bool(url)
+        if self.shared:
+            self.client = QdrantClient(url=url)
+        else:
+            self.client = QdrantClient(path=self.partition_path(path, tenant))
+
         # Create collection if it doesn't exist
         if not self.client.collection_exists(self.collection):
             self.client.create_collection(
                 collection_name=self.collection,
                 vectors_config=VectorParams(size=dim, distance=Distance.COSINE)
             )
+        if self.shared:
+            self._ensure_payload_indexes()
+
+    @staticmethod
+    def partition_path(path="qdrant_storage", tenant=None):
+        return os.path.join(path, "tenants", safe_tenant(tenant)) if tenant else path
+
+    @classmethod
+    def partition_exists(cls, tenant, path="qdrant_storage"):
+        if os.getenv("QDRANT_URL"):
+            return True  # tenants share one server collection
+        return os.path.isdir(cls.partition_path(path, tenant))
+
+    def _ensure_payload_indexes(self):
+        # Checked on every open so collections created before the indexes existed get them too.
+        indexes = {
+            "source": KeywordIndexParams(type=KeywordIndexType.KEYWORD),
+            "tenant": KeywordIndexParams(type=KeywordIndexType.KEYWORD, is_tenant=True),
+        }
+        existing = self.client.get_collection(self.collection).payload_schema or {}
+        for field_name, field_schema in indexes.items():
+            if field_name not in existing:
+                self.client.create_payload_index(
+                    collection_name=self.collection,
+                    field_name=field_name,
+                    field_schema=field_schema
+                )
 
     def upsert(self, ids, vectors, payloads):
         points = [
@@ -24,29 +64,40 @@ class QdrantStorage:
             points=points
         )
 
-    def search(self, query_vector, top_k=5, filter_sources=None):
-        from qdrant_client.models import Filter, FieldCondition, MatchAny
+    def search(self, query_vector, top_k=5, filter_sources=None, score_threshold=None):
+        from qdrant_client.models import Filter, FieldCondition, MatchAny, MatchValue
 
-        qdrant_filter = None
+        must = []
+        if self.shared and self.tenant:
+            must.append(
+                FieldCondition(
+                    key="tenant",
+                    match=MatchValue(value=self.tenant)
+                )
+            )
         if filter_sources: # Only filter if files were actually provided
-            qdrant_filter = Filter(
-                must=[
-                    FieldCondition(
-                        key="source",
-                        match=MatchAny(any=filter_sources)
-                    )
-                ]
+            must.append(
+                FieldCondition(
+                    key="source",
+                    match=MatchAny(any=filter_sources)
+                )
             )
+        qdrant_filter = None
+        if must:
+            qdrant_filter = Filter(must=must)
 
         results = self.client.query_points(
             collection_name=self.collection,
             query=query_vector,
             with_payload=True,
             limit=top_k,
-            query_filter=qdrant_filter
+            query_filter=qdrant_filter,
+            score_threshold=score_threshold
         )
 
+        ids = []
         contexts = []
+        context_sources = []
         sources = set()
 
         for r in results.points:
@@ -55,11 +106,32 @@ class QdrantStorage:
             source = payload.get("source", "")
 
             if text:
+                ids.append(str(r.id))
                 contexts.append(text)
+                context_sources.append(source)
                 if source:
                     sources.add(source)
 
         return {
+            "ids": ids,
             "contexts": contexts,
+            "context_sources": context_sources,
             "sources": list(sources),
         }
+
+
+def get_storage(tenant=None, fallback=False):
+    """
+    Returns the vector store selected by VECTOR_STORE ("qdrant" or "flat") for `tenant`.
+    With fallback=True a tenant that has no partition yet reads the unpartitioned
+    store instead, where chats ingested before per-chat partitioning live. Only
+    pass it for such chats: the shared store holds every older chat's documents.
+    """
+    if os.getenv("VECTOR_STORE", "qdrant") == "flat":
+        from flat_index import FlatIndexStorage
+        if tenant and fallback and not FlatIndexStorage.partition_exists(tenant):
+            tenant = None
+        return FlatIndexStorage(dtype=os.getenv("VECTOR_STORE_DTYPE", "float32"), tenant=tenant)
+    if tenant and fallback and not QdrantStorage.partition_exists(tenant):
+        tenant = None
+    return QdrantStorage(tenant=tenant)